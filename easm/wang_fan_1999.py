@@ -14,6 +14,43 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
+def box_idx(vals, lo, hi):
+    # Indices of sorted coordinate values with lo <= vals <= hi, found by bisection rather than comparing every value
+    # Descending axes are searched in reverse. If lo > hi (a longitude box crossing the grid edge) values >= lo or <= hi are taken
+    if len(vals) > 1 and vals[0] > vals[-1]:
+        return (len(vals) - 1 - box_idx(vals[::-1], lo, hi))[::-1]
+    i0 = np.searchsorted(vals, lo, side='left')
+    i1 = np.searchsorted(vals, hi, side='right')
+    if lo > hi:
+        return np.r_[0:i1, i0:len(vals)]
+    return np.arange(i0, i1)
+
+
+def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
+    # Rename coords to lat, lon and plev if needed, and select 850hPa level
+    if latdim != 'lat' or londim != 'lon': # Skip rename if names are already canonical
+        var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
+
+    if pdim in var_in.dims:
+        if punits == 'Pa':
+            lev=85000.
+        elif punits == 'hPa':
+            lev=850.
+        else:
+            print('Error, punits not recognised')
+            return
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
+        try:
+            var_in = var_in.sel(plev=lev, drop=True)
+        except:
+            print('Warning, 850hPa level not found, looking for nearest level')
+            var_in = var_in.sel(plev=lev, method='nearest')
+            print('Nearest level found: ' + str(int(var_in.plev.values)))
+    
+    return var_in
+
+
 def wang_fan(u, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='Pa'):
     # Inputs:
     # u: lat-lon DataArray of zonal wind speed. Input either only 850-hPa level, or specify pressure dimension to search for this level over
@@ -24,57 +61,48 @@ def wang_fan(u, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='
     # punits: Pressure units, default Pa
     
     # Returns:
-    # Time series of Wang and Fan 1999 index, where time axis matches that of input
+    # Time series of Wang and Fan 1999 index in float32, where time axis matches that of input
     
     # Rename coords for ease if needed
-    u = u.rename({latdim:'lat', londim:'lon'})
-    
-    if pdim in u.dims:
-        if punits == 'Pa':
-            lev=85000.
-        elif punits == 'hPa':
-            lev=850.
-        else:
-            print('Error, punits not recognised')
-            return
-        u = u.rename({pdim:'plev'})
-        try:
-            u = u.sel(plev=lev)
-        except:
-            print('Warning, 850hPa level not found, looking for nearest level')
-            u = u.sel(plev=lev, method='nearest')
-            print('Nearest level found: ' + str(int(u.plev.values)))
-            
+    u = rename_coords(u, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
+    if u is None:
+        return
+    u = u.astype(np.float32, copy=False) # Single precision is sufficient for the index and halves memory traffic
     
-    # Identify grid points in (5°–15°N, 90°–130°E)
-    lons1 = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= 90.  and u.lon[i] <= 130.]
-    lats1 = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= 5.   and u.lat[i] <= 15.]
+    # Identify indices of grid points in (5°–15°N, 90°–130°E)
+    lon_idx1 = box_idx(u.lon.values, 90., 130.)
+    lat_idx1 = box_idx(u.lat.values, 5., 15.)
     
-    # Identify grid points in (22.5°–32.5°N, 110°–140°E)
-    lons2 = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= 110.  and u.lon[i] <= 140.]
-    lats2 = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= 22.5  and u.lat[i] <= 32.5]
+    # Identify indices of grid points in (22.5°–32.5°N, 110°–140°E)
+    lon_idx2 = box_idx(u.lon.values, 110., 140.)
+    lat_idx2 = box_idx(u.lat.values, 22.5, 32.5)
     
     # Take weighted means of u over above boxes
     if areacell is not None:
-        areacell = areacell.rename({latdim:'lat', londim:'lon'})
+        if latdim != 'lat' or londim != 'lon':
+            areacell = areacell.rename({latdim:'lat', londim:'lon'})
         if (len(areacell.lat) == len(u.lat)) and (len(areacell.lon) == len(u.lon)):
             latsame = (np.round(areacell.lat.values - u.lat.values,2) ==0.).all()
             lonsame = (np.round(areacell.lon.values - u.lon.values,2) ==0.).all()
         else:
             latsame = False;  lonsame = False
         if latsame and lonsame:
-            u_wt = u * areacell # If cell area grid provided use this to area weight values before averaging
-            u1 = u_wt.sel(lon=lons1, lat=lats1, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats1, lon=lons1, method='nearest').sum(('lat','lon')) 
-            u2 = u_wt.sel(lon=lons2, lat=lats2, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats2, lon=lons2, method='nearest').sum(('lat','lon')) 
+            # If cell area grid provided use this to area weight values before averaging
+            # Grids match, so the box indices also pick out the cell areas, and only the boxes need weighting
+            area1 = areacell.isel(lat=lat_idx1, lon=lon_idx1).drop_vars(['lat','lon'], errors='ignore').astype(np.float32, copy=False)
+            area2 = areacell.isel(lat=lat_idx2, lon=lon_idx2).drop_vars(['lat','lon'], errors='ignore').astype(np.float32, copy=False)
+            u1 = (u.isel(lon=lon_idx1, lat=lat_idx1) * area1).sum(('lat','lon')) / area1.sum(('lat','lon')) 
+            u2 = (u.isel(lon=lon_idx2, lat=lat_idx2) * area2).sum(('lat','lon')) / area2.sum(('lat','lon')) 
         else:
             print('Warning, cell area dimensions do not match those of u, defaulting to using cosine weighted averaging')
             areacell = None
             
     if areacell is None:
-        coslat = np.cos(u.lat * np.pi/180.)
-        u_wt = u * coslat # In absence of cell area grid weight average by latitude before averaging
-        u1 = u_wt.sel(lon=lons1, lat=lats1, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats1, method='nearest').sum('lat')
-        u2 = u_wt.sel(lon=lons2, lat=lats2, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats2, method='nearest').sum('lat')
+        # In absence of cell area grid weight average by latitude before averaging, evaluating weights on box latitudes only
+        coslat1 = np.cos(u.lat.isel(lat=lat_idx1) * np.pi/180.).astype(np.float32)
+        coslat2 = np.cos(u.lat.isel(lat=lat_idx2) * np.pi/180.).astype(np.float32)
+        u1 = (u.isel(lon=lon_idx1, lat=lat_idx1) * coslat1).sum('lat').mean('lon') / coslat1.sum('lat')
+        u2 = (u.isel(lon=lon_idx2, lat=lat_idx2) * coslat2).sum('lat').mean('lon') / coslat2.sum('lat')
     
     return u1-u2 #Return shear
    
@@ -8,9 +8,23 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
-def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
-    
-    var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
+def box_idx(vals, lo, hi):
+    # Indices of sorted coordinate values with lo <= vals <= hi, found by bisection rather than comparing every value
+    # Descending axes are searched in reverse. If lo > hi (a longitude box crossing the grid edge) values >= lo or <= hi are taken
+    if len(vals) > 1 and vals[0] > vals[-1]:
+        return (len(vals) - 1 - box_idx(vals[::-1], lo, hi))[::-1]
+    i0 = np.searchsorted(vals, lo, side='left')
+    i1 = np.searchsorted(vals, hi, side='right')
+    if lo > hi:
+        return np.r_[0:i1, i0:len(vals)]
+    return np.arange(i0, i1)
+
+
+def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon', lat_bounds=None, lon_bounds=None):
+    # Rename coords, select 850hPa level and, if bounds are given, subset to the region of interest
+    # Selection is done before any data are loaded, so for Dask-backed input only the required slab is read
+    if latdim != 'lat' or londim != 'lon': # Skip rename if names are already canonical
+        var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
 
     if pdim in var_in.dims:
         if punits == 'Pa':
@@ -20,40 +34,116 @@ def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
         else:
             print('Error, punits not recognised')
             return
-        var_in = var_in.rename({pdim:'plev'})
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
         try:
-            var_in = var_in.sel(plev=lev)
+            var_in = var_in.sel(plev=lev, drop=True)
         except:
             print('Warning, 850hPa level not found, looking for nearest level')
             var_in = var_in.sel(plev=lev, method='nearest')
             print('Nearest level found: ' + str(int(var_in.plev.values)))
     
+    if lat_bounds is not None:
+        var_in = var_in.isel(lat=box_idx(var_in.lat.values, lat_bounds[0], lat_bounds[1]))
+    if lon_bounds is not None:
+        var_in = var_in.isel(lon=box_idx(var_in.lon.values, lon_bounds[0], lon_bounds[1]))
+    
+    # If Dask-backed, load the selected data now if it is small, so it is read only once; otherwise leave lazy
+    if var_in.chunks is not None and var_in.nbytes <= 2**30:
+        var_in = var_in.persist()
+    
     return var_in
 
 
+def abs_angle_kernel(u, v, u_rel, v_rel):
+    # Angle between wind vectors (u, v) and (u_rel, v_rel), from numpy arrays
+    # Work arrays are updated in place, so only two full-size arrays are allocated rather than one per term
+    # Evaluated in float64 whatever the input precision, as onset and withdrawal are picked by argmax of changes in this angle
+    angle = np.multiply(u_rel, u, dtype=np.float64)
+    angle += v_rel * v
+    mag = np.square(u, dtype=np.float64)
+    mag += v**2.
+    np.sqrt(mag, out=mag)
+    mag *= np.sqrt(u_rel**2. + v_rel**2.)
+    angle /= mag
+    return np.arccos(angle, out=angle)
+
+
 def abs_angle(u, v, u_rel, v_rel):
-    u_mag = np.sqrt(u**2. + v**2.)
-    u_rel_mag = np.sqrt(u_rel**2. + v_rel**2.)
-    return np.arccos( (u_rel*u + v_rel*v) / (u_mag * u_rel_mag) )
+    # Evaluated blockwise on the underlying arrays by abs_angle_kernel, so Dask-backed inputs stay lazy
+    return xr.apply_ufunc(abs_angle_kernel, u, v, u_rel, v_rel, dask='parallelized', output_dtypes=[np.float64])
 
 
 def smooth_data(var_in, timedim='time'):
     # Smooth data
+    # Dask-backed input stays lazy, with the FFT evaluated chunk by chunk over the spatial dimensions
+    if var_in.chunks is not None:
+        var_in = var_in.chunk({timedim: -1}) # FFT needs the whole time series, so hold time in a single chunk
     var_mean = var_in.mean(timedim) # save mean
     var_in = var_in - var_mean # subtract
-    axisno = var_in.get_axis_num(timedim) # Find number of pentad dimension
-    var_fft = np.fft.fft(var_in.values, axis=axisno) # Take fourer transform along pentad dimension - use fft not rfft to conserve axis length
-    # Discard all but 1st 12 harmonics
-    if axisno==0:
-        var_fft[12:-12,:,:] = 0
-    elif axisno==1:
-        var_fft[:,12:-12,:] = 0
-    elif axisno==2:
-        var_fft[:,:,12:-12] = 0
-    var_smooth = np.fft.ifft(var_fft, axis=axisno) # Take inverse fourier transform to recover smoothed timeseries
-    var_smooth = xr.DataArray(var_smooth.real, coords=var_in.coords, dims=var_in.dims) # Make dataarray
+    axisno = var_in.get_axis_num(timedim) # Find number of time dimension
+    var_fft = np.fft.rfft(var_in.data, axis=axisno) # Take real fourier transform along time dimension - input is real so only non-negative frequencies are needed
+    # Discard all but 1st 12 harmonics - as for the full fft truncated to [12:-12], this keeps half of the 12th harmonic
+    # Series of 24 steps or fewer have no harmonics to discard, and pass through unchanged
+    if var_in.shape[axisno] > 24:
+        sl = [slice(None)] * var_fft.ndim # Index along time axis only, for any number of dimensions
+        sl[axisno] = 12; var_fft[tuple(sl)] *= 0.5
+        sl[axisno] = slice(13, None); var_fft[tuple(sl)] = 0
+    var_smooth = np.fft.irfft(var_fft, n=var_in.shape[axisno], axis=axisno) # Take inverse fourier transform to recover smoothed timeseries, giving length to conserve axis length
+    var_smooth = xr.DataArray(var_smooth, coords=var_in.coords, dims=var_in.dims) # Make dataarray
     var_smooth = var_smooth + var_mean # Add mean back on
     return var_smooth
+
+
+def full_windows(cond, p, timedim='time'):
+    # Flag, for each start time i, whether cond holds at every time from i to i+p-1
+    # Returns boolean array with time moved to the first axis, of length len(time)-p+1
+    c = np.moveaxis(cond.values, cond.get_axis_num(timedim), 0)
+    csum = np.zeros((c.shape[0]+1,) + c.shape[1:], dtype=np.int32)
+    np.cumsum(c, axis=0, out=csum[1:]) # Running count of times meeting cond, so each window sum is a single difference
+    return (csum[p:] - csum[:-p]) == p
+
+
+def time_to_numeric(time):
+    # Convert time coordinate to floats in the units used by xarray's differentiate:
+    # the native unit of datetime64 coordinates, or seconds for cftime coordinates
+    tvals = time.values
+    if np.issubdtype(tvals.dtype, np.datetime64):
+        return (tvals - tvals[0]) / np.timedelta64(1, np.datetime_data(tvals.dtype)[0])
+    elif tvals.dtype == object:
+        return np.array([(t - tvals[0]).total_seconds() for t in tvals])
+    return tvals.astype(float)
+
+
+def window_slopes(var, n, timedim='time'):
+    # Mean slope over each n-point window, as var.isel(time=range(i,i+n)).differentiate(timedim).mean(timedim) gives for start time i
+    # Interior points of a window share the central differences of the full series; only the two end points use one-sided differences
+    # Returns array with time moved to the first axis, of length len(time)-n+1
+    f = np.moveaxis(var.values, var.get_axis_num(timedim), 0)
+    x = time_to_numeric(var[timedim])
+    g = np.gradient(f, x, axis=0) # Central differences away from the ends of the series
+    d = np.diff(f, axis=0) / np.diff(x).reshape((-1,) + (1,)*(f.ndim-1)) # One-sided differences
+    
+    # Sum and count non-nan derivatives in each window, so that nans are skipped as in xarray's mean
+    inner = np.lib.stride_tricks.sliding_window_view(np.nan_to_num(g[1:-1]), n-2, axis=0).sum(axis=-1)
+    count = np.lib.stride_tricks.sliding_window_view(~np.isnan(g[1:-1]), n-2, axis=0).sum(axis=-1)
+    for d_end in (d[:len(d)-n+2], d[n-2:]):
+        inner += np.nan_to_num(d_end)
+        count += ~np.isnan(d_end)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return inner / count
+
+
+def slope_change(var, timedim='time'):
+    # Change in slope at each time i, arctan of the mean slope over the 10 times before i minus that over the 9 times after i
+    # Evaluated for i from 10 to len(time)-11, zero elsewhere
+    # Returns array with time moved to the first axis
+    nt = len(var[timedim])
+    b1 = window_slopes(var, 10, timedim=timedim)[:nt-20] # Windows i-10 to i-1
+    b2 = window_slopes(var, 9, timedim=timedim)[11:nt-9] # Windows i+1 to i+9
+    b = np.zeros((nt,) + b1.shape[1:])
+    b[10:nt-10] = np.arctan(b1) - np.arctan(b2)
+    return b
         
 
 def li_zhang(u, v, p=15, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='Pa', smooth=False):
@@ -68,12 +158,8 @@ def li_zhang(u, v, p=15, areacell=None, latdim='lat', londim='lon', pdim='plev',
     
     # Returns:
         
-    u = rename_coords(u, latdim=latdim, londim=londim, pdim=pdim, punits=punits)
-    v = rename_coords(v, latdim=latdim, londim=londim, pdim=pdim, punits=punits)
-    
-    lats = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= 0. and u.lat[i] <= 40.]
-    lons = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= 40. and u.lon[i] <= 180.]
-    u = u.sel(lon=lons, lat=lats);     v = v.sel(lon=lons, lat=lats)
+    u = rename_coords(u, latdim=latdim, londim=londim, pdim=pdim, punits=punits, lat_bounds=(0., 40.), lon_bounds=(40., 180.))
+    v = rename_coords(v, latdim=latdim, londim=londim, pdim=pdim, punits=punits, lat_bounds=(0., 40.), lon_bounds=(40., 180.))
     
     if smooth:
         u = smooth_data(u); v = smooth_data(v)
@@ -95,44 +181,30 @@ def li_zhang(u, v, p=15, areacell=None, latdim='lat', londim='lon', pdim='plev',
     # Condition a, find first time where beta remains above half the july/aug climatological value for p days or more
     cond_a_onset = beta_onset > beta_julaug/2.
     
-    a = np.zeros(cond_a_onset.shape)
-    for i in range(len(cond_a_onset.time)-p):
-        a[:,:,i] = xr.where(cond_a_onset.isel(time=range(i,i+p)).sum('time') == p, i, np.nan).values
-    a = xr.DataArray(a, dims=cond_a_onset.dims, coords=cond_a_onset.coords) 
-    a = a.isel(time=range(1,len(a.time)-p))
-    a = a.min('time')
+    full = full_windows(cond_a_onset, p)[1:-1] # Windows starting at times 1 to len(time)-p-1
+    a = np.where(full.any(axis=0), full.argmax(axis=0) + 1, np.nan) # First start time of a full window
     
     # Condition b, find the time where the slope of beta changes fastest
-    b = np.zeros(beta_onset.shape)
-    for i in range(10,len(beta_onset.time)-10):
-        b1 = beta_onset.isel(time=range(i-10,i)).differentiate('time').mean('time')
-        b2 = beta_onset.isel(time=range(i+1,i+10)).differentiate('time').mean('time')
-        a_mask = i >= a.values
-        b[:,:,i] = (np.arctan(b1)-np.arctan(b2)) * a_mask
-    
-    b = xr.DataArray(b, dims=beta_onset.dims, coords=beta_onset.coords) 
+    b = slope_change(beta_onset)
+    times = np.arange(len(b)).reshape((-1,) + (1,)*(b.ndim-1))
+    b = b * (times >= a)
+    
+    b = xr.DataArray(np.moveaxis(b, 0, beta_onset.get_axis_num('time')), dims=beta_onset.dims, coords=beta_onset.coords) 
     onset = np.round((b.argmax('time')+1) /5.)
     
     
     # Condition a, find first time where beta remains above half the july/aug climatological value for p days or more
     cond_a_withdrawal = beta_withdrawal > beta_julaug/2.
     #print(cond_a_withdrawal[0,0,:])
-    a = np.zeros(cond_a_withdrawal.shape)
-    for i in range(len(cond_a_withdrawal.time)-1, p-1, -1):
-        a[:,:,i] = xr.where(cond_a_withdrawal.isel(time=range(i,i-p,-1)).sum('time') == p, i, np.nan).values
-    a = xr.DataArray(a, dims=cond_a_withdrawal.dims, coords=cond_a_withdrawal.coords) 
-    a = a.isel(time=range(p,len(a.time)))
-    a = a.max('time')
+    full = full_windows(cond_a_withdrawal, p)[1:] # Windows ending at times p to len(time)-1
+    a = np.where(full.any(axis=0), len(full) - full[::-1].argmax(axis=0) + p - 1, np.nan) # Last end time of a full window
     
     # Condition b, find the time where the slope of beta changes fastest
-    b = np.zeros(beta_withdrawal.shape)
-    for i in range(10,len(beta_withdrawal.time)-10):
-        b1 = beta_withdrawal.isel(time=range(i-10,i)).differentiate('time').mean('time')
-        b2 = beta_withdrawal.isel(time=range(i+1,i+10)).differentiate('time').mean('time')
-        a_mask = i <= a.values
-        b[:,:,i] = (np.arctan(b1)-np.arctan(b2)) * a_mask
-    
-    b = xr.DataArray(b, dims=beta_withdrawal.dims, coords=beta_withdrawal.coords) 
+    b = slope_change(beta_withdrawal)
+    times = np.arange(len(b)).reshape((-1,) + (1,)*(b.ndim-1))
+    b = b * (times <= a)
+    
+    b = xr.DataArray(np.moveaxis(b, 0, beta_withdrawal.get_axis_num('time')), dims=beta_withdrawal.dims, coords=beta_withdrawal.coords) 
     offset = np.where(beta.time.values==b.time.min().values)[0][0]
     withdrawal = np.round((b.argmax('time')+1 + offset) /5.)
     
@@ -11,6 +11,27 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
+def smooth_data(var_in, timedim='time'):
+    # Smooth data
+    # Dask-backed input stays lazy, with the FFT evaluated chunk by chunk over the spatial dimensions
+    if var_in.chunks is not None:
+        var_in = var_in.chunk({timedim: -1}) # FFT needs the whole time series, so hold time in a single chunk
+    var_mean = var_in.mean(timedim) # save mean
+    var_in = var_in - var_mean # subtract
+    axisno = var_in.get_axis_num(timedim) # Find number of time dimension
+    var_fft = np.fft.rfft(var_in.data, axis=axisno) # Take real fourier transform along time dimension - input is real so only non-negative frequencies are needed
+    # Discard all but 1st 12 harmonics - as for the full fft truncated to [12:-12], this keeps half of the 12th harmonic
+    # Series of 24 steps or fewer have no harmonics to discard, and pass through unchanged
+    if var_in.shape[axisno] > 24:
+        sl = [slice(None)] * var_fft.ndim # Index along time axis only, for any number of dimensions
+        sl[axisno] = 12; var_fft[tuple(sl)] *= 0.5
+        sl[axisno] = slice(13, None); var_fft[tuple(sl)] = 0
+    var_smooth = np.fft.irfft(var_fft, n=var_in.shape[axisno], axis=axisno) # Take inverse fourier transform to recover smoothed timeseries, giving length to conserve axis length
+    var_smooth = xr.DataArray(var_smooth, coords=var_in.coords, dims=var_in.dims) # Make dataarray
+    var_smooth = var_smooth + var_mean # Add mean back on
+    return var_smooth
+
+
 def wang_linho(p_pentad, p_month, latdim='lat', londim='lon', pentaddim='pentad'):
     # Inputs:
     # p_pentad: lat-lon-time DataArray of precipitation, units mm/day, time units pentad
@@ -21,39 +42,23 @@ def wang_linho(p_pentad, p_month, latdim='lat', londim='lon', pentaddim='pentad'
     # Returns:
     # Onset, peak and withdrawal pentads, and season duration in pentads
     
-    # Smooth data
-    p_mean = p_pentad.mean(pentaddim) # save mean
-    p_pentad = p_pentad - p_mean # subtract
-    axisno = p_pentad.get_axis_num(pentaddim) # Find number of pentad dimension
-    p_fft = np.fft.fft(p_pentad.values, axis=axisno) # Take fourer transform along pentad dimension - use fft not rfft to conserve axis length
-    # Discard all but 1st 12 harmonics
-    if axisno==0:
-        p_fft[12:-12,:,:] = 0
-    elif axisno==1:
-        p_fft[:,12:-12,:] = 0
-    elif axisno==2:
-        p_fft[:,:,12:-12] = 0
-    p_smooth = np.fft.ifft(p_fft, axis=axisno) # Take inverse fourier transform to recover smoothed timeseries
-    p_smooth = xr.DataArray(p_smooth.real, coords=p_pentad.coords, dims=p_pentad.dims) # Make dataarray
-    p_pentad = p_smooth + p_mean # Add mean back on
+    p_pentad = p_pentad.astype(np.float32, copy=False) # Single precision is sufficient for the index and halves memory traffic
+    p_month = p_month.astype(np.float32, copy=False)
+    p_pentad = smooth_data(p_pentad, timedim=pentaddim) # Smooth data using mean + 12 harmonics
     
     rain_rel = p_pentad - p_month
     
-    rain_rel_masked = np.ma.masked_less(rain_rel.values, 5)  # Mask relative rainfall where it is less than 5mm/day
-
-    onset_index = np.ma.notmasked_edges(rain_rel_masked, axis=0) # Look along pentad axis to find edges of mask
-    onset = np.zeros((len(rain_rel[latdim]),len(rain_rel[londim]))) # Create array of nans to load onsets into
-    onset[:] = np.nan
-    withdrawal = np.zeros((len(rain_rel[latdim]),len(rain_rel[londim]))) # Create array of nans to load onsets into
-    withdrawal[:] = np.nan
+    season = rain_rel.values >= 5  # Find where relative rainfall is at least 5mm/day
+    in_season = season.any(axis=0)
     
-    for i in range(0,len(onset_index[0][1])): # Extract onsets from mask edges
-        onset[ onset_index[0][1][i], onset_index[0][2][i] ] = onset_index[0][0][i]+1
-        withdrawal[ onset_index[1][1][i], onset_index[1][2][i] ] = onset_index[1][0][i]+1
+    # Look along pentad axis for first and last pentads meeting threshold
+    onset = np.where(in_season, season.argmax(axis=0)+1, np.nan)
+    withdrawal = np.where(in_season, season.shape[0] - season[::-1].argmax(axis=0), np.nan)
+    peak = np.where(season, rain_rel.values, -np.inf).argmax(axis=0)+1.
         
-    onset_pentad = xr.DataArray(onset, [(latdim, rain_rel[latdim]), (londim, rain_rel[londim])]) # Make dataarray
-    withdrawal_pentad = xr.DataArray(withdrawal, [(latdim, rain_rel[latdim]), (londim, rain_rel[londim])]) # Make dataarray
-    peak_pentad = xr.DataArray(rain_rel_masked.argmax(axis=0) + 1., [(latdim, rain_rel[latdim]), (londim, rain_rel[londim])]) # Make dataarray
+    onset_pentad = xr.DataArray(onset, [(latdim, rain_rel[latdim].values), (londim, rain_rel[londim].values)]) # Make dataarray
+    withdrawal_pentad = xr.DataArray(withdrawal, [(latdim, rain_rel[latdim].values), (londim, rain_rel[londim].values)]) # Make dataarray
+    peak_pentad = xr.DataArray(peak, [(latdim, rain_rel[latdim].values), (londim, rain_rel[londim].values)]) # Make dataarray
     peak_pentad = peak_pentad.where(peak_pentad!=1.)
     
     duration = withdrawal_pentad - onset_pentad
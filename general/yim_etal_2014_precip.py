@@ -21,6 +21,18 @@ regions = {
   }
 
 
+def box_idx(vals, lo, hi):
+    # Indices of sorted coordinate values with lo <= vals <= hi, found by bisection rather than comparing every value
+    # Descending axes are searched in reverse. If lo > hi (a longitude box crossing the grid edge) values >= lo or <= hi are taken
+    if len(vals) > 1 and vals[0] > vals[-1]:
+        return (len(vals) - 1 - box_idx(vals[::-1], lo, hi))[::-1]
+    i0 = np.searchsorted(vals, lo, side='left')
+    i1 = np.searchsorted(vals, hi, side='right')
+    if lo > hi:
+        return np.r_[0:i1, i0:len(vals)]
+    return np.arange(i0, i1)
+
+
 def yim_precip(p, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='Pa', region='IN'):
     # Inputs:
     # p: lat-lon(+time/pressure) DataArray of precipitation.
@@ -30,10 +42,12 @@ def yim_precip(p, areacell=None, latdim='lat', londim='lon', pdim='plev', punits
     # region: Key for 'regions' dictionary
     
     # Returns:
-    # Time series of Yim et al. 2014 precip mean, where time axis matches that of input
+    # Time series of Yim et al. 2014 precip mean in float32, where time axis matches that of input
     
     # Rename coords for ease if needed
-    p = p.rename({latdim:'lat', londim:'lon'})
+    if latdim != 'lat' or londim != 'lon':
+        p = p.rename({latdim:'lat', londim:'lon'})
+    p = p.astype(np.float32, copy=False) # Single precision is sufficient for the index and halves memory traffic
     
       
     [[lata,latb],[lona,lonb]] = regions[region]
@@ -44,33 +58,33 @@ def yim_precip(p, areacell=None, latdim='lat', londim='lon', pdim='plev', punits
         else:
             lona = lona - 360.;
     
-    # Identify grid points in region
-    if lonb > lona:
-        lons = [p.lon[i].values for i in range(len(p.lon)) if p.lon[i] >= lona  and p.lon[i] <= lonb]
-    else:
-        lons = [p.lon[i].values for i in range(len(p.lon)) if p.lon[i] >= lona or p.lon[i] <= lonb]
-    lats = [p.lat[i].values for i in range(len(p.lat)) if p.lat[i] >= lata   and p.lat[i] <= latb]
+    # Identify indices of grid points in region
+    lon_idx = box_idx(p.lon.values, lona, lonb) # Box may cross the grid edge, e.g. NAF
+    lat_idx = box_idx(p.lat.values, lata, latb)
     
     # Take weighted means of u over above boxes
     if areacell is not None:
-        areacell = areacell.rename({latdim:'lat', londim:'lon'})
+        if latdim != 'lat' or londim != 'lon':
+            areacell = areacell.rename({latdim:'lat', londim:'lon'})
         if (len(areacell.lat) == len(p.lat)) and (len(areacell.lon) == len(p.lon)):
             latsame = (np.round(areacell.lat.values - p.lat.values,2) ==0.).all()
             lonsame = (np.round(areacell.lon.values - p.lon.values,2) ==0.).all()
         else:
             latsame = False;  lonsame = False
         if latsame and lonsame:
-            p_wt = p * areacell # If cell area grid provided use this to area weight values before averaging
-            p_mean = p_wt.sel(lon=lons, lat=lats, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats, lon=lons, method='nearest').sum(('lat','lon')) 
+            # If cell area grid provided use this to area weight values before averaging
+            # Grids match, so the box indices also pick out the cell areas, and only the box needs weighting
+            area = areacell.isel(lat=lat_idx, lon=lon_idx).drop_vars(['lat','lon'], errors='ignore').astype(np.float32, copy=False)
+            p_mean = (p.isel(lon=lon_idx, lat=lat_idx) * area).sum(('lat','lon')) / area.sum(('lat','lon')) 
             
         else:
             print('Warning, cell area dimensions do not match those of p, defaulting to using cosine weighted averaging')
             areacell = None
             
     if areacell is None:
-        coslat = np.cos(p.lat * np.pi/180.)
-        p_wt = p * coslat # In absence of cell area grid weight average by latitude before averaging
-        p_mean = p_wt.sel(lon=lons, lat=lats, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats, method='nearest').sum('lat')
+        # In absence of cell area grid weight average by latitude before averaging, evaluating weights on box latitudes only
+        coslat = np.cos(p.lat.isel(lat=lat_idx) * np.pi/180.).astype(np.float32)
+        p_mean = (p.isel(lon=lon_idx, lat=lat_idx) * coslat).sum('lat').mean('lon') / coslat.sum('lat')
 
             
     return p_mean #Return area mean precip
@@ -20,6 +20,43 @@ regions = {
   }
 
 
+def box_idx(vals, lo, hi):
+    # Indices of sorted coordinate values with lo <= vals <= hi, found by bisection rather than comparing every value
+    # Descending axes are searched in reverse. If lo > hi (a longitude box crossing the grid edge) values >= lo or <= hi are taken
+    if len(vals) > 1 and vals[0] > vals[-1]:
+        return (len(vals) - 1 - box_idx(vals[::-1], lo, hi))[::-1]
+    i0 = np.searchsorted(vals, lo, side='left')
+    i1 = np.searchsorted(vals, hi, side='right')
+    if lo > hi:
+        return np.r_[0:i1, i0:len(vals)]
+    return np.arange(i0, i1)
+
+
+def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
+    # Rename coords to lat, lon and plev if needed, and select 850hPa level
+    if latdim != 'lat' or londim != 'lon': # Skip rename if names are already canonical
+        var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
+
+    if pdim in var_in.dims:
+        if punits == 'Pa':
+            lev=85000.
+        elif punits == 'hPa':
+            lev=850.
+        else:
+            print('Error, punits not recognised')
+            return
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
+        try:
+            var_in = var_in.sel(plev=lev, drop=True)
+        except:
+            print('Warning, 850hPa level not found, looking for nearest level')
+            var_in = var_in.sel(plev=lev, method='nearest')
+            print('Nearest level found: ' + str(int(var_in.plev.values)))
+    
+    return var_in
+
+
 def yim_vort(u, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='Pa', region='ISM'):
     # Inputs:
     # u: lat-lon(+time/pressure) DataArray of zonal wind speed. Input either only 850-hPa level, or specify pressure dimension to search for this level over
@@ -31,71 +68,61 @@ def yim_vort(u, areacell=None, latdim='lat', londim='lon', pdim='plev', punits='
     # region: Key for 'regions' dictionary
     
     # Returns:
-    # Time series of Yim et al. 2014 index, where time axis matches that of input
+    # Time series of Yim et al. 2014 index in float32, where time axis matches that of input
     
     # Rename coords for ease if needed
-    u = u.rename({latdim:'lat', londim:'lon'})
+    u = rename_coords(u, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
+    if u is None:
+        return
+    u = u.astype(np.float32, copy=False) # Single precision is sufficient for the index and halves memory traffic
     
-    if pdim in u.dims:
-        if punits == 'Pa':
-            lev=85000.
-        elif punits == 'hPa':
-            lev=850.
-        else:
-            print('Error, punits not recognised')
-            return
-        u = u.rename({pdim:'plev'})
-        try:
-            u = u.sel(plev=lev)
-        except:
-            print('Warning, 850hPa level not found, looking for nearest level')
-            u = u.sel(plev=lev, method='nearest')
-            print('Nearest level found: ' + str(int(u.plev.values)))
-            
     [[[lat1a,lat1b],[lon1a,lon1b]], [[lat2a,lat2b],[lon2a,lon2b]]] = regions[region]
     
     if u.lon.min() < -10.:
         print('check')
         lon1a = lon1a - 360.; lon1b = lon1b - 360.; lon2a = lon2a - 360.; lon2b = lon2b - 360.
     
-    # Identify grid points in region
-    lons1 = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= lon1a  and u.lon[i] <= lon1b]
-    lats1 = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= lat1a   and u.lat[i] <= lat1b]
+    # Identify indices of grid points in region, with sign of each box in the shear
+    boxes = [(box_idx(u.lat.values, lat1a, lat1b), box_idx(u.lon.values, lon1a, lon1b), 1.)]
     
     if region is not 'NAFSM':
-        lons2 = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= lon2a  and u.lon[i] <= lon2b]
-        lats2 = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= lat2a  and u.lat[i] <= lat2b]
+        boxes.append((box_idx(u.lat.values, lat2a, lat2b), box_idx(u.lon.values, lon2a, lon2b), -1.))
     
     # Take weighted means of u over above boxes
     if areacell is not None:
-        areacell = areacell.rename({latdim:'lat', londim:'lon'})
+        if latdim != 'lat' or londim != 'lon':
+            areacell = areacell.rename({latdim:'lat', londim:'lon'})
         if (len(areacell.lat) == len(u.lat)) and (len(areacell.lon) == len(u.lon)):
             latsame = (np.round(areacell.lat.values - u.lat.values,2) ==0.).all()
             lonsame = (np.round(areacell.lon.values - u.lon.values,2) ==0.).all()
         else:
             latsame = False;  lonsame = False
         if latsame and lonsame:
-            u_wt = u * areacell # If cell area grid provided use this to area weight values before averaging
-            u1 = u_wt.sel(lon=lons1, lat=lats1, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats1, lon=lons1, method='nearest').sum(('lat','lon')) 
-            
-            if region is not 'NAFSM':
-                u2 = u_wt.sel(lon=lons2, lat=lats2, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats2, lon=lons2, method='nearest').sum(('lat','lon')) 
-            else:
-                u2=0.
+            # If cell area grid provided use this to area weight values before averaging
+            # Grids match, so the box indices also pick out the cell areas
+            area = areacell.transpose('lat','lon').values
         else:
             print('Warning, cell area dimensions do not match those of u, defaulting to using cosine weighted averaging')
             areacell = None
-            
-    if areacell is None:
-        coslat = np.cos(u.lat * np.pi/180.)
-        u_wt = u * coslat # In absence of cell area grid weight average by latitude before averaging
-        u1 = u_wt.sel(lon=lons1, lat=lats1, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats1, method='nearest').sum('lat')
-        
-        if region is not 'NAFSM':
-            u2 = u_wt.sel(lon=lons2, lat=lats2, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats2, method='nearest').sum('lat')
+    
+    # If either box holds no grid points its mean, and so the shear, is undefined
+    if any(len(lat_idx) == 0 or len(lon_idx) == 0 for lat_idx, lon_idx, _ in boxes):
+        return u.isel(lat=slice(0,0), lon=slice(0,0)).sum(('lat','lon')) * np.nan
+    
+    # Combine the box means into one weighted sum over the bounding box of both boxes, so the shear takes a single pass over u
+    # Weights sum to +1 over the first box and -1 over the second, and are zero elsewhere
+    lat_box = np.arange(min(b[0].min() for b in boxes), max(b[0].max() for b in boxes)+1)
+    lon_box = np.arange(min(b[1].min() for b in boxes), max(b[1].max() for b in boxes)+1)
+    weights = np.zeros((len(lat_box), len(lon_box)))
+    for lat_idx, lon_idx, sign in boxes:
+        if areacell is not None:
+            w = area[np.ix_(lat_idx, lon_idx)]
         else:
-            u2=0.
-            
-    return u1-u2 #Return shear
+            # In absence of cell area grid weight average by latitude, evaluating weights on box latitudes only
+            w = np.repeat(np.cos(u.lat.values[lat_idx] * np.pi/180.)[:,None], len(lon_idx), axis=1)
+        weights[np.ix_(lat_idx - lat_box[0], lon_idx - lon_box[0])] += sign * w / w.sum()
+    weights = xr.DataArray(weights.astype(np.float32), dims=['lat','lon'])
+    
+    return (u.isel(lat=lat_box, lon=lon_box) * weights).sum(('lat','lon')) #Return shear
    
    
@@ -12,6 +12,11 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
+try:
+    import numexpr as ne # Optional, used for theta_e if available
+except ImportError:
+    ne = None
+
 cp_air = 1004.6
 L = 2.507e6
 rdgas = 287.04
@@ -19,37 +24,123 @@ rvgas = 461.50
 tfreeze = 273.16
 a = 6371.e3
 
-def sat_vap_pres(t):
+def sat_vap_pres(t, p=None):
     # Calculate saturation vapor pressure 
+    # p: Pressure, by default the plev coordinate of t
+    if p is None:
+        p = t.plev
     es = 610.78 * np.exp(-1.* L/rvgas * (1/t - 1/tfreeze))
     # e = rp/0.622 -> r = 0.622e/p
-    rs = 0.622 * es / (t.plev)
+    rs = 0.622 * es / p
     return es, rs
     
     
-def equiv_pot_t_ams(t, q):
-    # Calculate: theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)]
-        
-    # Assume water only present in air in vapour form, so rt = rv = r:
-    r = q/(1-q)
+def level_pressure(t):
+    # Pressure for theta_e calculation, as a plain float if plev is a scalar coordinate so it is a scalar constant in the kernel
+    p = t.plev.astype(t.dtype)
+    if p.ndim == 0:
+        return float(p)
+    return p
+    
+    
+def equiv_pot_t_kernel(t, q, p, need_saturated=False):
+    # Calculate theta_equiv, and theta_equiv_s if need_saturated, from numpy arrays of temperature, specific humidity and pressure
+    # Work arrays are updated in place, so only a few full-size arrays are allocated rather than one per term
     c = 4217. # heat capacity of liquid water at 0 degrees
-    denom = cp_air + r*c
-
-    # H = q/qs = e/es  relative humidity
-    es, rs = sat_vap_pres(t)
-    rh = r/rs
-    denom_s = cp_air + rs*c
     
-    theta_equiv = t * (100000./t.plev)**(rdgas/denom) * rh**(-r * rvgas/denom) * np.exp(L * r/denom/t)
+    # Log of saturation mixing ratio, log(rs) = log(0.622 es/p), with es as in sat_vap_pres
+    # Taken directly from the exponent of es, so rs itself is only evaluated if theta_equiv_s is needed
+    log_rs = 1./t
+    log_rs -= 1./tfreeze
+    log_rs *= -1.* L/rvgas
+    log_rs += np.log(0.622 * 610.78 / p)
+    
+    # Assume water only present in air in vapour form, so rt = rv = r:
+    r = 1. - q
+    np.divide(q, r, out=r)
+    denom = r * c
+    denom += cp_air
+    
+    # theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)], with H = r/rs
+    # Powers are combined into a single exponential, T exp([Rd log(po/p) - rvRv log(H) + Lvr/T] / (cpd + rtc)), with log(H) = log(r) - log(rs)
+    rd_log_p = rdgas * np.log(100000./p)
+    theta_equiv = np.log(r, out=np.zeros_like(r), where=r > 0.) # Dry air, r = 0, contributes r*log(H) = 0, as H^0 = 1
+    theta_equiv -= log_rs
+    theta_equiv *= -1.* rvgas
+    work = np.divide(L, t)
+    theta_equiv += work
+    theta_equiv *= r
+    theta_equiv += rd_log_p
+    theta_equiv /= denom
+    np.exp(theta_equiv, out=theta_equiv)
+    theta_equiv *= t
+    
+    if not need_saturated:
+        return theta_equiv
+    
+    # theta_equiv_s = T(po/pd)^[Rd/(cpd + rstc)] * e^[Lvrs / ((cpd + rstc)T)], evaluated as T exp([Rd log(po/p) + Lvrs/T] / (cpd + rstc))
+    rs = np.exp(log_rs, out=log_rs)
+    np.multiply(rs, c, out=denom)
+    denom += cp_air
+    theta_equiv_s = np.multiply(work, rs, out=work) # work holds L/T
+    theta_equiv_s += rd_log_p
+    theta_equiv_s /= denom
+    np.exp(theta_equiv_s, out=theta_equiv_s)
+    theta_equiv_s *= t
+    
+    return theta_equiv, theta_equiv_s
+    
+    
+def equiv_pot_t_numexpr(t, q, p, need_saturated=False):
+    # As equiv_pot_t_kernel, with theta_equiv, and theta_equiv_s if need_saturated, each evaluated by numexpr in a single threaded pass
+    # Constants are passed in the input precision, as numexpr would otherwise promote float32 input to float64
+    consts = {'cp_air': cp_air, 'L': L, 'rvgas': rvgas, 'tfreeze': tfreeze, 'c': 4217., 'one': 1., 'zero': 0.,
+              'rd_log_p': rdgas * np.log(100000./p), 'log_es0_p': np.log(0.622 * 610.78 / p)}
+    consts = {k: np.asarray(v, dtype=t.dtype) for k, v in consts.items()}
+    log_rs = 'log_es0_p - L/rvgas * (one/t - one/tfreeze)'
+    
+    r = ne.evaluate('q / (one - q)', local_dict=dict(consts, q=q))
+    theta_equiv = ne.evaluate('t * exp((rd_log_p - r*rvgas*where(r > zero, log(r) - (' + log_rs + '), zero) + L*r/t) / (cp_air + r*c))', local_dict=dict(consts, t=t, r=r))
+    
+    if not need_saturated:
+        return theta_equiv
+    
+    rs = ne.evaluate('exp(' + log_rs + ')', local_dict=dict(consts, t=t))
+    theta_equiv_s = ne.evaluate('t * exp((rd_log_p + L*rs/t) / (cp_air + rs*c))', local_dict=dict(consts, t=t, rs=rs))
     
-    theta_equiv_s = t * (100000./t.plev)**(rdgas/denom_s) * np.exp(L * rs/denom_s/t)
-     
     return theta_equiv, theta_equiv_s
     
+    
+def equiv_pot_t_ams(t, q, need_saturated=False):
+    # Calculate: theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)]
+    # Saturated theta_equiv_s is only evaluated if need_saturated is True, otherwise None is returned in its place
+    # Evaluated blockwise on the underlying arrays by equiv_pot_t_kernel, or equiv_pot_t_numexpr if numexpr is installed, so Dask-backed inputs stay lazy
+    nout = 2 if need_saturated else 1
+    p = level_pressure(t)
+    kernel = equiv_pot_t_kernel if ne is None else equiv_pot_t_numexpr
+    theta = xr.apply_ufunc(kernel, t, q, p, kwargs={'need_saturated': need_saturated}, output_core_dims=[[]]*nout,
+                           dask='parallelized', output_dtypes=[t.dtype]*nout)
+    return theta if need_saturated else (theta, None)
+    
+
+
+def box_idx(vals, lo, hi):
+    # Indices of sorted coordinate values with lo <= vals <= hi, found by bisection rather than comparing every value
+    # Descending axes are searched in reverse. If lo > hi (a longitude box crossing the grid edge) values >= lo or <= hi are taken
+    if len(vals) > 1 and vals[0] > vals[-1]:
+        return (len(vals) - 1 - box_idx(vals[::-1], lo, hi))[::-1]
+    i0 = np.searchsorted(vals, lo, side='left')
+    i1 = np.searchsorted(vals, hi, side='right')
+    if lo > hi:
+        return np.r_[0:i1, i0:len(vals)]
+    return np.arange(i0, i1)
 
 
-def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
-    var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
+def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon', lat_bounds=None, lon_bounds=None):
+    # Rename coords, select 850hPa level and, if bounds are given, subset to the region of interest
+    # Selection is done before any data are loaded, so for Dask-backed input only the required slab is read
+    if latdim != 'lat' or londim != 'lon': # Skip rename if names are already canonical
+        var_in = var_in.rename({latdim: 'lat', londim: 'lon'})
 
     if pdim in var_in.dims:
         if punits == 'Pa':
@@ -59,7 +150,8 @@ def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
         else:
             print('Error, punits not recognised')
             return
-        var_in = var_in.rename({pdim:'plev'})
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
         try:
             var_in = var_in.sel(plev=lev)
         except:
@@ -67,12 +159,45 @@ def rename_coords(var_in, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
             var_in = var_in.sel(plev=lev, method='nearest')
             print('Nearest level found: ' + str(int(var_in.plev.values)))
     
+    if lat_bounds is not None:
+        var_in = var_in.isel(lat=box_idx(var_in.lat.values, lat_bounds[0], lat_bounds[1]))
+    if lon_bounds is not None:
+        var_in = var_in.isel(lon=box_idx(var_in.lon.values, lon_bounds[0], lon_bounds[1]))
+    
+    # If Dask-backed, load the selected data now if it is small, so it is read only once; otherwise leave lazy
+    if var_in.chunks is not None and var_in.nbytes <= 2**30:
+        var_in = var_in.persist()
+    
     return var_in
     
 
+def find_front(dthetady, lats, dthdy_threshold, cellno_threshold, continuity_threshold, nlats):
+    # Inputs:
+    # dthetady: numpy array of absolute meridional gradient of equivalent potential temperature, with lat and lon as the last two axes
+    # lats: Latitudes of dthetady
+    # dthdy_threshold, cellno_threshold, continuity_threshold: Thresholds on gradient, number of frontal cells and front continuity
+    # nlats: Number of latitudes in study area
+    
+    # Returns:
+    # Mean latitude of frontal cells at each longitude, nan where criteria for a front are not met
+    
+    front = dthetady > dthdy_threshold
+    nfront = front.sum(axis=-2) # Number of frontal cells at each longitude
+    with np.errstate(invalid='ignore', divide='ignore'): # Longitudes with no frontal cells are left as nan
+        mbf_lats = (front * lats[:,None]).sum(axis=-2) / nfront
+    
+    mbfno = nfront.sum(axis=-1)
+    mbf_lats[mbfno <= cellno_threshold] = np.nan
+    
+    continuous = np.nansum(np.abs(np.diff(mbf_lats, axis=-1)), axis=-1)/(nlats-1) < continuity_threshold
+    mbf_lats[~continuous] = np.nan
+    
+    return mbf_lats
+    
+
 def li_meiyu(t, q, areacell=None, pdim='plev', punits='Pa', latdim='lat', londim='lon'):
     # Inputs:
-    # t, q: lat-lon (+pressure, time) DataArrays of temperature and specific humidity
+    # t, q: lat-lon (+pressure, time) DataArrays of temperature and specific humidity. May be Dask-backed, chunked along time only
     # areacell: Grid of cell areas for spatial averaging
     # latdim: Name of latitude dimension, default lat
     # londim: Name of longitude dimension, default lon
@@ -81,11 +206,15 @@ def li_meiyu(t, q, areacell=None, pdim='plev', punits='Pa', latdim='lat', londim
     
     # Returns: 
     # mbf_lats: Meiyu-Baiu front latitudes for each input time
-    # dtheta/dy: Meridional gradient of equivalent potential temperature for checking
+    # dtheta/dy: Meridional gradient of equivalent potential temperature for checking, in float32
     
-    # Rename coords for ease if needed
-    q = rename_coords(q, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
-    t = rename_coords(t, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
+    # Rename coords for ease if needed, and subset to study area
+    # Keep a grid point either side of the study area in latitude for the centred meridional gradient
+    dlat = np.abs(t[latdim].values[1] - t[latdim].values[0])
+    lat_bounds = (22. - 1.5*dlat, 40. + 1.5*dlat); lon_bounds = (105., 145.)
+    q = rename_coords(q, pdim=pdim, punits=punits, latdim=latdim, londim=londim, lat_bounds=lat_bounds, lon_bounds=lon_bounds)
+    t = rename_coords(t, pdim=pdim, punits=punits, latdim=latdim, londim=londim, lat_bounds=lat_bounds, lon_bounds=lon_bounds)
+    t = t.astype(np.float32, copy=False); q = q.astype(np.float32, copy=False) # Single precision is sufficient for the front detection and halves memory traffic
     
     
     lonres = (t.lon[1]-t.lon[0]).values
@@ -99,32 +228,33 @@ def li_meiyu(t, q, areacell=None, pdim='plev', punits='Pa', latdim='lat', londim
         dthdy_threshold = 0.04
         continuity_threshold = 1.
         
-    lons = [t.lon[i].values for i in range(len(t.lon)) if t.lon[i] >= 105. and t.lon[i] <= 145.] # 80 * 36 = 2880
-    lats = [t.lat[i].values for i in range(len(t.lat)) if t.lat[i] >= 22.  and t.lat[i] <= 40.]
+    lon_idx = box_idx(t.lon.values, 105., 145.) # 80 * 36 = 2880
+    lat_idx = box_idx(t.lat.values, 22., 40.)
     
     # 0.5 degree grid in original study has 2880 cells in study area
     # sets threshold of 200 cells must meet threshold for MBF day 
     # 200/2880 simplifies to 5./72.
-    nlons = len(lons)
-    nlats = len(lats)
+    nlons = len(lon_idx)
+    nlats = len(lat_idx)
     cellno_threshold = 5./72. * nlons * nlats
         
-    theta_equiv, theta_equiv_s = equiv_pot_t_ams(t, q)
-    
-    dthetady = theta_equiv.differentiate('lat') / a * 180./np.pi * 1000.
-    
-    lons = [dthetady.lon[i].values for i in range(len(dthetady.lon)) if dthetady.lon[i] >= 105. and dthetady.lon[i] <= 145.]
-    lats = [dthetady.lat[i].values for i in range(len(dthetady.lat)) if dthetady.lat[i] >= 22.  and dthetady.lat[i] <= 40.]
-    
-    dthetady = np.abs(dthetady.sel(lon=lons, lat=lats))
-    
-    mbf_lats = dthetady.lat.where(dthetady > dthdy_threshold).mean('lat')
+    theta_equiv, _ = equiv_pot_t_ams(t, q, need_saturated=False)
     
-    mbfno = (dthetady>dthdy_threshold).sum(('lat','lon'))
-    mbf_lats = mbf_lats.where(mbfno > cellno_threshold)
+    # Meridional gradient at the study area latitudes only, with degrees to km folded into the spacing
+    # Centred difference where both neighbours are present, falling back to one-sided differences at the ends of the array, as differentiate does
+    theta_equiv = theta_equiv.isel(lon=lon_idx)
+    upper = np.minimum(lat_idx + 1, len(t.lat) - 1); lower = np.maximum(lat_idx - 1, 0)
+    latax = theta_equiv.get_axis_num('lat')
+    dy = (t.lat.values[upper] - t.lat.values[lower]) * np.pi/180. * a/1000.
+    dy = dy.reshape((-1,) + (1,)*(theta_equiv.ndim-latax-1)).astype(theta_equiv.dtype)
+    dthetady = (theta_equiv.isel(lat=upper).data - theta_equiv.isel(lat=lower).data) / dy
+    dthetady = np.abs(xr.DataArray(dthetady, dims=theta_equiv.dims, coords=theta_equiv.isel(lat=lat_idx).coords))
     
-    continuous = np.abs(mbf_lats.diff('lon')).sum('lon')/(nlats-1) < continuity_threshold
-    mbf_lats = mbf_lats.where(continuous==True)
+    # Locate front separately for each lat-lon slice, so Dask-backed inputs chunked along time are processed a chunk at a time
+    mbf_lats = xr.apply_ufunc(find_front, dthetady, input_core_dims=[['lat','lon']], output_core_dims=[['lon']],
+                              kwargs={'lats': dthetady.lat.values, 'dthdy_threshold': dthdy_threshold, 'cellno_threshold': cellno_threshold, 
+                                      'continuity_threshold': continuity_threshold, 'nlats': nlats},
+                              dask='parallelized', output_dtypes=[float])
     
     return mbf_lats, dthetady
 
@@ -11,6 +11,11 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
+try:
+    import numexpr as ne # Optional, used for theta_e if available
+except ImportError:
+    ne = None
+
 cp_air = 1004.6
 L = 2.507e6
 rdgas = 287.04
@@ -18,37 +23,112 @@ rvgas = 461.50
 tfreeze = 273.16
 a = 6371.e3
 
-def sat_vap_pres(t):
+def sat_vap_pres(t, p=None):
     # Calculate saturation vapor pressure 
+    # p: Pressure, by default the plev coordinate of t
+    if p is None:
+        p = t.plev
     es = 610.78 * np.exp(-1.* L/rvgas * (1/t - 1/tfreeze))
     # e = rp/0.622 -> r = 0.622e/p
-    rs = 0.622 * es / (t.plev)
+    rs = 0.622 * es / p
     return es, rs
     
     
-def equiv_pot_t_ams(t, q):
-    # Calculate: theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)]
-        
-    # Assume water only present in air in vapour form, so rt = rv = r:
-    r = q/(1-q)
+def level_pressure(t):
+    # Pressure for theta_e calculation, as a plain float if plev is a scalar coordinate so it is a scalar constant in the kernel
+    p = t.plev.astype(t.dtype)
+    if p.ndim == 0:
+        return float(p)
+    return p
+    
+    
+def equiv_pot_t_kernel(t, q, p, need_saturated=False):
+    # Calculate theta_equiv, and theta_equiv_s if need_saturated, from numpy arrays of temperature, specific humidity and pressure
+    # Work arrays are updated in place, so only a few full-size arrays are allocated rather than one per term
     c = 4217. # heat capacity of liquid water at 0 degrees
-    denom = cp_air + r*c
-
-    # H = q/qs = e/es  relative humidity
-    es, rs = sat_vap_pres(t)
-    rh = r/rs
-    denom_s = cp_air + rs*c
     
-    theta_equiv = t * (100000./t.plev)**(rdgas/denom) * rh**(-r * rvgas/denom) * np.exp(L * r/denom/t)
+    # Log of saturation mixing ratio, log(rs) = log(0.622 es/p), with es as in sat_vap_pres
+    # Taken directly from the exponent of es, so rs itself is only evaluated if theta_equiv_s is needed
+    log_rs = 1./t
+    log_rs -= 1./tfreeze
+    log_rs *= -1.* L/rvgas
+    log_rs += np.log(0.622 * 610.78 / p)
+    
+    # Assume water only present in air in vapour form, so rt = rv = r:
+    r = 1. - q
+    np.divide(q, r, out=r)
+    denom = r * c
+    denom += cp_air
+    
+    # theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)], with H = r/rs
+    # Powers are combined into a single exponential, T exp([Rd log(po/p) - rvRv log(H) + Lvr/T] / (cpd + rtc)), with log(H) = log(r) - log(rs)
+    rd_log_p = rdgas * np.log(100000./p)
+    theta_equiv = np.log(r, out=np.zeros_like(r), where=r > 0.) # Dry air, r = 0, contributes r*log(H) = 0, as H^0 = 1
+    theta_equiv -= log_rs
+    theta_equiv *= -1.* rvgas
+    work = np.divide(L, t)
+    theta_equiv += work
+    theta_equiv *= r
+    theta_equiv += rd_log_p
+    theta_equiv /= denom
+    np.exp(theta_equiv, out=theta_equiv)
+    theta_equiv *= t
+    
+    if not need_saturated:
+        return theta_equiv
+    
+    # theta_equiv_s = T(po/pd)^[Rd/(cpd + rstc)] * e^[Lvrs / ((cpd + rstc)T)], evaluated as T exp([Rd log(po/p) + Lvrs/T] / (cpd + rstc))
+    rs = np.exp(log_rs, out=log_rs)
+    np.multiply(rs, c, out=denom)
+    denom += cp_air
+    theta_equiv_s = np.multiply(work, rs, out=work) # work holds L/T
+    theta_equiv_s += rd_log_p
+    theta_equiv_s /= denom
+    np.exp(theta_equiv_s, out=theta_equiv_s)
+    theta_equiv_s *= t
     
-    theta_equiv_s = t * (100000./t.plev)**(rdgas/denom_s) * np.exp(L * rs/denom_s/t)
-     
     return theta_equiv, theta_equiv_s
     
+    
+def equiv_pot_t_numexpr(t, q, p, need_saturated=False):
+    # As equiv_pot_t_kernel, with theta_equiv, and theta_equiv_s if need_saturated, each evaluated by numexpr in a single threaded pass
+    # Constants are passed in the input precision, as numexpr would otherwise promote float32 input to float64
+    consts = {'cp_air': cp_air, 'L': L, 'rvgas': rvgas, 'tfreeze': tfreeze, 'c': 4217., 'one': 1., 'zero': 0.,
+              'rd_log_p': rdgas * np.log(100000./p), 'log_es0_p': np.log(0.622 * 610.78 / p)}
+    consts = {k: np.asarray(v, dtype=t.dtype) for k, v in consts.items()}
+    log_rs = 'log_es0_p - L/rvgas * (one/t - one/tfreeze)'
+    
+    r = ne.evaluate('q / (one - q)', local_dict=dict(consts, q=q))
+    theta_equiv = ne.evaluate('t * exp((rd_log_p - r*rvgas*where(r > zero, log(r) - (' + log_rs + '), zero) + L*r/t) / (cp_air + r*c))', local_dict=dict(consts, t=t, r=r))
+    
+    if not need_saturated:
+        return theta_equiv
+    
+    rs = ne.evaluate('exp(' + log_rs + ')', local_dict=dict(consts, t=t))
+    theta_equiv_s = ne.evaluate('t * exp((rd_log_p + L*rs/t) / (cp_air + rs*c))', local_dict=dict(consts, t=t, rs=rs))
+    
+    return theta_equiv, theta_equiv_s
+    
+    
+def equiv_pot_t_ams(t, q, need_saturated=False):
+    # Calculate: theta_equiv = T(po/pd)^[Rd/(cpd + rtc)] * H^[-rvRv/(cpd + rtc)] * e^[Lvrv / ((cpd + rtc)T)]
+    # Saturated theta_equiv_s is only evaluated if need_saturated is True, otherwise None is returned in its place
+    # Evaluated blockwise on the underlying arrays by equiv_pot_t_kernel, or equiv_pot_t_numexpr if numexpr is installed, so Dask-backed inputs stay lazy
+    # Computed in float32, which is ample for the 335K onset threshold and halves memory traffic
+    t = t.astype(np.float32, copy=False); q = q.astype(np.float32, copy=False)
+    p = level_pressure(t)
+    nout = 2 if need_saturated else 1
+    kernel = equiv_pot_t_kernel if ne is None else equiv_pot_t_numexpr
+    theta = xr.apply_ufunc(kernel, t, q, p, kwargs={'need_saturated': need_saturated}, output_core_dims=[[]]*nout,
+                           dask='parallelized', output_dtypes=[np.float32]*nout)
+    return theta if need_saturated else (theta, None)
+    
 
 
 def rename_coords(var_in, pentaddim='pentad', pdim='plev', punits='Pa', latdim='lat', londim='lon'):
-    var_in = var_in.rename({pentaddim: 'pentad', latdim: 'lat', londim: 'lon'})
+    names = {k: v for k, v in {pentaddim: 'pentad', latdim: 'lat', londim: 'lon'}.items() if k != v}
+    if names: # Skip rename if names are already canonical
+        var_in = var_in.rename(names)
 
     if pdim in var_in.dims:
         if punits == 'Pa':
@@ -58,48 +138,90 @@ def rename_coords(var_in, pentaddim='pentad', pdim='plev', punits='Pa', latdim='
         else:
             print('Error, punits not recognised')
             return
-        var_in = var_in.rename({pdim:'plev'})
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
         try:
             var_in = var_in.sel(plev=lev)
         except:
             print('Warning, 850hPa level not found, looking for nearest level')
             var_in = var_in.sel(plev=lev, method='nearest')
             print('Nearest level found: ' + str(int(var_in.plev.values)))
+        
+        # If Dask-backed, load the selected level now if it is small, so it is read only once; otherwise leave lazy
+        if var_in.chunks is not None and var_in.nbytes <= 2**30:
+            var_in = var_in.persist()
     
     return var_in
 
 
-def area_mean(var_in, areacell=None):
+def area_mean(var_in, areacell=None, latdim='lat', londim='lon', lat_bounds=(10., 20.), lon_bounds=(110., 120.)):
+    # Weighted mean over box of a DataArray, or of all variables in a Dataset at once so weights and box selection are shared
     
-    # Get specified lats and lons, select pentad range to look at
-    lats = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= 10. and u.lat[i] <= 20.]
-    lons = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= 110. and u.lon[i] <= 120.]
+    # Get positional slices for specified lats and lons, ordered as the coordinates are, to apply to both data and cell areas
+    lat_box = var_in.indexes['lat'].slice_indexer(*(lat_bounds[::-1] if var_in.lat.values[0] > var_in.lat.values[-1] else lat_bounds))
+    lon_box = var_in.indexes['lon'].slice_indexer(*lon_bounds)
     
     # Take weighted means over above box
     if areacell is not None:
-        areacell = areacell.rename({latdim:'lat', londim:'lon'})
+        if latdim != 'lat' or londim != 'lon':
+            areacell = areacell.rename({latdim:'lat', londim:'lon'})
         if (len(areacell.lat) == len(var_in.lat)) and (len(areacell.lon) == len(var_in.lon)):
-            latsame = (np.round(areacell.lat.values - var_in.lat.values,2) ==0.).all()
-            lonsame = (np.round(areacell.lon.values - var_in.lon.values,2) ==0.).all()
+            latsame = np.allclose(areacell.lat.values, var_in.lat.values, rtol=0., atol=0.005) # Coordinates agree to 2 decimal places
+            lonsame = np.allclose(areacell.lon.values, var_in.lon.values, rtol=0., atol=0.005)
         else:
             latsame = False;  lonsame = False
         if latsame and lonsame:
-            var_in_wt = var_in * areacell # If cell area grid provided use this to area weight values before averaging
-            var_in_mean = var_in_wt.sel(lon=lons, lat=lats, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats, lon=lons, method='nearest').sum(('lat','lon')) 
+            # If cell area grid provided use this to area weight values before averaging
+            # Grids match, so the same box slices pick out the cell areas, which are then used for both weighting and normalising
+            area = areacell.isel(lat=lat_box, lon=lon_box).drop_vars(['lat','lon'], errors='ignore')
+            var_in_mean = (var_in.isel(lon=lon_box, lat=lat_box) * area).sum(('lat','lon')) / area.sum(('lat','lon')) 
         else:
             print('Warning, cell area dimensions do not match those of u, defaulting to using cosine weighted averaging')
             areacell = None
             
     if areacell is None:
-        coslat = np.cos(var_in.lat * np.pi/180.)
-        var_in_wt = var_in * coslat # In absence of cell area grid weight average by latitude before averaging
-        var_in_mean = var_in_wt.sel(lon=lons, lat=lats, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats, method='nearest').sum('lat')
+        # In absence of cell area grid weight average by latitude before averaging, evaluating weights on box latitudes only
+        coslat = np.cos(var_in.lat.isel(lat=lat_box) * np.pi/180.)
+        var_in_mean = (var_in.isel(lon=lon_box, lat=lat_box) * coslat).sum('lat').mean('lon') / coslat.sum('lat')
     
     return var_in_mean
     
 
 
 
+def onset_scan(th, u, pentads):
+    # Inputs:
+    # th, u: numpy arrays of area mean equivalent potential temperature and zonal wind speed for each pentad
+    # pentads: Corresponding pentad numbers
+    
+    # Returns:
+    # Onset pentad, or nan if none found
+    
+    u_pos = u > 0.
+    
+    # Only look for onset in seasonal window of pentads 15-45, and where the series extends 5 pentads beyond for the steadiness check
+    i0 = np.searchsorted(pentads, 15)
+    i1 = min(np.searchsorted(pentads, 45, side='right'), len(u_pos) - 5)
+    if i1 <= i0:
+        return np.nan
+    
+    def shifted(x, k):
+        return x[i0+k:i1+k] # Values k pentads after each candidate pentad
+    
+    # Check first if u and theta_eq exceed their thresholds, and u remains positive for at least 2 pentads
+    cand = (shifted(th, 0) > 335.) & shifted(u_pos, 0) & shifted(u_pos, 1)
+    # Now check steadiness. Is u either steady for 3 pentads with a break of 2 or fewer?
+    steady3 = shifted(u_pos, 2) & (shifted(u_pos, 3) | shifted(u_pos, 4) | shifted(u_pos, 5))
+    # Or steady for 2 pentads with a break of only 1?
+    steady2 = ~shifted(u_pos, 2) & shifted(u_pos, 3)
+    
+    # If above are met, return first such pentad
+    onset = cand & (steady3 | steady2)
+    if onset.any():
+        return pentads[i0 + onset.argmax()]
+    return np.nan
+
+
 def gao_onset(t, q, u, areacell=None, pdim='plev', punits='Pa', pentaddim='pentad', latdim='lat', londim='lon'):
     # Inputs:
     # t, q, u: Single years of pentad mean temperature, specific humidity and zonal wind speed
@@ -111,7 +233,7 @@ def gao_onset(t, q, u, areacell=None, pdim='plev', punits='Pa', pentaddim='penta
     # pentaddim: Name of pentad dimension, default 'pentad'
     
     # Returns:
-    # SCSM onset pentad
+    # SCSM onset pentad, or None if none found
     
     # Rename coords for ease if needed
     q = rename_coords(q, pdim=pdim, punits=punits, pentaddim=pentaddim, latdim=latdim, londim=londim)
@@ -119,22 +241,37 @@ def gao_onset(t, q, u, areacell=None, pdim='plev', punits='Pa', pentaddim='penta
     u = rename_coords(u, pdim=pdim, punits=punits, pentaddim=pentaddim, latdim=latdim, londim=londim)
     
     # Get equivalent potential temperature
-    th_e, th_es = equiv_pot_t_ams(t, q)
-    
-    # Get area means from 10-20N, 110-120E
-    th_e_mean = area_mean(th_e, areacell=areacell)
-    u_mean = area_mean(u, areacell=areacell)
-    u_pos = (u_mean > 0.) * 1.
-    
-    for i in range(len(u_mean.pentad)):  # For each pentad:
-        if (th_e_mean.isel(pentad=i) > 335.) and (u_pos.isel(pentad=i) > 0.) and (u_pos.isel(pentad=i+1) > 0.): 
-            # Check first if u and theta_eq exceed their thresholds, and u remains positive for at least 2 pentads
-            # Now check steadiness. Is u either steady for 3 pentads with a break of 2 or fewer?
-            if (u_pos.isel(pentad=i+2) > 0.) and (u_pos.isel(pentad=range(i+3,i+6)).sum('pentad') > 0.):
-                return int(u_pos.pentad[i].values)
-            # Or steady for 2 pentads with a break of only 1?
-            elif (u_pos.isel(pentad=i+2) < 0.) and (u_pos.isel(pentad=[i+3]) > 0.):
-                return int(u_pos.pentad[i].values)
-            # If above are met, return pentad, otherwise continue to next pentad.
-                
-    return  None
+    th_e, _ = equiv_pot_t_ams(t, q)
+    
+    # Get area means from 10-20N, 110-120E, together in a single pass
+    means = area_mean(xr.Dataset({'th_e': th_e, 'u': u}), areacell=areacell, latdim=latdim, londim=londim)
+    
+    # Scan pentads on the underlying arrays, rather than indexing the DataArrays one pentad at a time
+    onset = onset_scan(means.th_e.values, means.u.values, means.pentad.values)
+    
+    if np.isnan(onset):
+        return None
+    return int(onset)
+
+
+def gao_onset_many(t, q, u, areacell=None, pdim='plev', punits='Pa', pentaddim='pentad', latdim='lat', londim='lon'):
+    # Inputs:
+    # t, q, u: Pentad mean temperature, specific humidity and zonal wind speed, with further dimensions, e.g. year, over which onset is found separately
+    # May be Dask-backed, chunked along the further dimensions, to process years in parallel
+    # Other inputs as for gao_onset
+    
+    # Returns:
+    # SCSM onset pentad for each year (or other further dimensions), nan where none found
+    
+    # Rename coords for ease if needed
+    q = rename_coords(q, pdim=pdim, punits=punits, pentaddim=pentaddim, latdim=latdim, londim=londim)
+    t = rename_coords(t, pdim=pdim, punits=punits, pentaddim=pentaddim, latdim=latdim, londim=londim)
+    u = rename_coords(u, pdim=pdim, punits=punits, pentaddim=pentaddim, latdim=latdim, londim=londim)
+    
+    # Get equivalent potential temperature and area means as for a single year
+    th_e, _ = equiv_pot_t_ams(t, q)
+    means = area_mean(xr.Dataset({'th_e': th_e, 'u': u}), areacell=areacell, latdim=latdim, londim=londim)
+    
+    # Scan each pentad series separately
+    return xr.apply_ufunc(onset_scan, means.th_e, means.u, input_core_dims=[['pentad'], ['pentad']], kwargs={'pentads': means.pentad.values},
+                          vectorize=True, dask='parallelized', dask_gufunc_kwargs={'allow_rechunk': True}, output_dtypes=[float])
@@ -9,23 +9,12 @@ __author__      = "Ruth Geen"
 import numpy as np
 import xarray as xr
 
-def scsm_onset(u, areacell=None, pentaddim='pentad', pdim='plev', punits='Pa', latdim='lat', londim='lon'):
-    # Inputs:
-    # u: 1 year long lat-lon-pentad DataArray of zonal wind speed. Input either only 850-hPa level, or specify pressure dimension
-    # areacell: Grid of cell areas for spatial averaging
-    # latdim: Name of latitude dimension, default lat
-    # londim: Name of longitude dimension, default lon
-    # pdim: Name of pressure dimension, default plev
-    # punits: Pressure units, default Pa
-    
-    # Returns:
-    # Area average of u over relevant box
-    # Onset pentad of SCSM for that year as per Wang et al. 2004 index, or None if none found
+def rename_coords(var_in, pentaddim='pentad', pdim='plev', punits='Pa', latdim='lat', londim='lon'):
+    names = {k: v for k, v in {pentaddim: 'pentad', latdim: 'lat', londim: 'lon'}.items() if k != v}
+    if names: # Skip rename if names are already canonical
+        var_in = var_in.rename(names)
     
-    # Rename coords for ease if needed
-    u = u.rename({pentaddim: 'pentad', latdim: 'lat', londim: 'lon'})
-    
-    if pdim in u.dims:
+    if pdim in var_in.dims:
         if punits == 'Pa':
             lev=85000.
         elif punits == 'hPa':
@@ -33,52 +22,127 @@ def scsm_onset(u, areacell=None, pentaddim='pentad', pdim='plev', punits='Pa', l
         else:
             print('Error, punits not recognised')
             return
-        u = u.rename({pdim:'plev'})
+        if pdim != 'plev':
+            var_in = var_in.rename({pdim:'plev'})
         try:
-            u = u.sel(plev=lev)
+            var_in = var_in.sel(plev=lev)
         except:
             print('Warning, 850hPa level not found, looking for nearest level')
-            u = u.sel(plev=lev, method='nearest')
-            print('Nearest level found: ' + str(int(u.plev.values)))
+            var_in = var_in.sel(plev=lev, method='nearest')
+            print('Nearest level found: ' + str(int(var_in.plev.values)))
+        
+        # If Dask-backed, load the selected level now if it is small, so it is read only once; otherwise leave lazy
+        if var_in.chunks is not None and var_in.nbytes <= 2**30:
+            var_in = var_in.persist()
     
+    return var_in
+
+
+def area_mean(u, areacell=None, latdim='lat', londim='lon', lat_bounds=(5., 15.), lon_bounds=(110., 120.)):
+    # Weighted mean over box of a DataArray, or of all variables in a Dataset at once
     
-    # Get specified lats and lons, select pentad range to look at
-    lats = [u.lat[i].values for i in range(len(u.lat)) if u.lat[i] >= 5. and u.lat[i] <= 15.]
-    lons = [u.lon[i].values for i in range(len(u.lon)) if u.lon[i] >= 110. and u.lon[i] <= 120.]
-    pentads = [u.pentad[i].values for i in range(len(u.pentad)) if u.pentad[i] >=  24]
+    # Get positional slices for specified lats and lons, ordered as the coordinates are, to apply to both data and cell areas
+    lat_box = u.indexes['lat'].slice_indexer(*(lat_bounds[::-1] if u.lat.values[0] > u.lat.values[-1] else lat_bounds))
+    lon_box = u.indexes['lon'].slice_indexer(*lon_bounds)
     
     # Take weighted means of u over above box
     if areacell is not None:
-        areacell = areacell.rename({latdim:'lat', londim:'lon'})
+        if latdim != 'lat' or londim != 'lon':
+            areacell = areacell.rename({latdim:'lat', londim:'lon'})
         if (len(areacell.lat) == len(u.lat)) and (len(areacell.lon) == len(u.lon)):
-            latsame = (np.round(areacell.lat.values - u.lat.values,2) ==0.).all()
-            lonsame = (np.round(areacell.lon.values - u.lon.values,2) ==0.).all()
+            latsame = np.allclose(areacell.lat.values, u.lat.values, rtol=0., atol=0.005) # Coordinates agree to 2 decimal places
+            lonsame = np.allclose(areacell.lon.values, u.lon.values, rtol=0., atol=0.005)
         else:
             latsame = False;  lonsame = False
         if latsame and lonsame:
-            u_wt = u * areacell # If cell area grid provided use this to area weight values before averaging
-            u_mean = u_wt.sel(lon=lons, lat=lats, method='nearest').sum(('lat','lon')) / areacell.sel(lat=lats, lon=lons, method='nearest').sum(('lat','lon')) 
+            # If cell area grid provided use this to area weight values before averaging
+            # Grids match, so the same box slices pick out the cell areas, which are then used for both weighting and normalising
+            area = areacell.isel(lat=lat_box, lon=lon_box).drop_vars(['lat','lon'], errors='ignore')
+            u_mean = (u.isel(lon=lon_box, lat=lat_box) * area).sum(('lat','lon')) / area.sum(('lat','lon')) 
         else:
             print('Warning, cell area dimensions do not match those of u, defaulting to using cosine weighted averaging')
             areacell = None
             
     if areacell is None:
-        coslat = np.cos(u.lat * np.pi/180.)
-        u_wt = u * coslat # In absence of cell area grid weight average by latitude before averaging
-        u_mean = u_wt.sel(lon=lons, lat=lats, method='nearest').sum('lat').mean('lon') / coslat.sel(lat=lats, method='nearest').sum('lat')
+        # In absence of cell area grid weight average by latitude before averaging, evaluating weights on box latitudes only
+        coslat = np.cos(u.lat.isel(lat=lat_box) * np.pi/180.)
+        u_mean = (u.isel(lon=lon_box, lat=lat_box) * coslat).sum('lat').mean('lon') / coslat.sum('lat')
+    
+    return u_mean
+
+
+def onset_scan(u_mean, pentads):
+    # Inputs:
+    # u_mean: numpy array of area mean zonal wind for pentads from 24 onward
+    # pentads: Corresponding pentad numbers
+    
+    # Returns:
+    # Onset pentad, or nan if none found
     
+    # Only look for onset up to pentad 45, and where the series extends 3 pentads beyond for the 4 pentad checks
+    n = min(np.searchsorted(pentads, 45, side='right'), len(pentads) - 3)
     
-    for i in range(len(pentads)):  # For each pentad after pentad 24
-        u_pos_mean = (u_mean.sel(pentad=pentads[i+1:i+5]).where(u_mean.sel(pentad=pentads[i+1:i+5]).values > 0.)).mean('pentad')
-        if ((u_mean.sel(pentad=pentads[i]).values) > 0.  # Check if u_mean is greater than zero
-             and (u_mean.sel(pentad=pentads[i:i+4]).sum('pentad') > 1.) # and if the u_mean over that pentad and next 3 is greater than 1
-             and (np.sum(u_mean.sel(pentad=pentads[i:i+4]).values > 0.) >= 2.)): # and if u_mean is greater than zero in at least 3 out of 4 pentads
-            onset_pentad = pentads[i]  # If all that is true, that's your onset pentad
-            return u_mean, onset_pentad # Return it, and u
+    # No onset can be found in a series shorter than the 4 pentad window
+    if len(u_mean) < 4:
+        return np.nan
     
-    return u_mean, None # Return u and an empty value if no onset found
+    # Sums of u_mean, and counts of pentads where u_mean is positive, over each pentad and the next 3, evaluated once
+    sum4 = np.convolve(u_mean, np.ones(4), 'valid')
+    pos4 = np.convolve(u_mean > 0., np.ones(4, dtype=int), 'valid')
+    
+    for i in range(n):  # For each pentad from pentad 24
+        if ((u_mean[i]) > 0.  # Check if u_mean is greater than zero
+             and (sum4[i] > 1.) # and if the u_mean over that pentad and next 3 is greater than 1
+             and (pos4[i] >= 2.)): # and if u_mean is greater than zero in at least 3 out of 4 pentads
+            return pentads[i]  # If all that is true, that's your onset pentad
+    
+    return np.nan
 
 
+def scsm_onset(u, areacell=None, pentaddim='pentad', pdim='plev', punits='Pa', latdim='lat', londim='lon'):
+    # Inputs:
+    # u: 1 year long lat-lon-pentad DataArray of zonal wind speed. Input either only 850-hPa level, or specify pressure dimension
+    # areacell: Grid of cell areas for spatial averaging
+    # latdim: Name of latitude dimension, default lat
+    # londim: Name of longitude dimension, default lon
+    # pdim: Name of pressure dimension, default plev
+    # punits: Pressure units, default Pa
+    
+    # Returns:
+    # Area average of u over relevant box
+    # Onset pentad of SCSM for that year as per Wang et al. 2004 index, or None if none found
+    
+    # Rename coords for ease if needed
+    u = rename_coords(u, pentaddim=pentaddim, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
+    
+    u_mean = area_mean(u, areacell=areacell, latdim=latdim, londim=londim)
+    
+    # Select pentad range to look at
+    u_late = u_mean.sel(pentad=slice(24, None))
+    onset_pentad = onset_scan(u_late.values, u_late.pentad.values)
+    
+    if np.isnan(onset_pentad):
+        return u_mean, None # Return u and an empty value if no onset found
+    return u_mean, onset_pentad # Return it, and u
 
 
-    
\ No newline at end of file
+def scsm_onset_many(u, areacell=None, pentaddim='pentad', pdim='plev', punits='Pa', latdim='lat', londim='lon'):
+    # Inputs:
+    # u: lat-lon-pentad DataArray of zonal wind speed, with further dimensions, e.g. year, over which onset is found separately
+    # May be Dask-backed, chunked along the further dimensions, to process years in parallel
+    # Other inputs as for scsm_onset
+    
+    # Returns:
+    # Area average of u over relevant box
+    # Onset pentad of SCSM for each year (or other further dimensions), nan where none found
+    
+    u = rename_coords(u, pentaddim=pentaddim, pdim=pdim, punits=punits, latdim=latdim, londim=londim)
+    
+    u_mean = area_mean(u, areacell=areacell, latdim=latdim, londim=londim)
+    
+    # Scan each pentad series separately
+    u_late = u_mean.sel(pentad=slice(24, None))
+    onset_pentad = xr.apply_ufunc(onset_scan, u_late, input_core_dims=[['pentad']], kwargs={'pentads': u_late.pentad.values},
+                                  vectorize=True, dask='parallelized', dask_gufunc_kwargs={'allow_rechunk': True}, output_dtypes=[float])
+    
+    return u_mean, onset_pentad